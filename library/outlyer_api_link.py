@@ -6,7 +6,30 @@ try:
 except ImportError:
     HAS_REQUESTS = False
 
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
+# use_float only exists from ijson 3.1, older versions hand numbers back as Decimals
+try:
+    IJSON_USE_FLOAT = HAS_IJSON and tuple(int(v) for v in ijson.__version__.split('.')[:2]) >= (3, 1)
+except (AttributeError, ValueError):
+    IJSON_USE_FLOAT = False
+
 import json
+import codecs
+from decimal import Decimal
+import cProfile
+import pstats
+import resource
+import traceback
+import hashlib
+import os
+import glob
+import time
+import fcntl
 
 def get_api_url(module, restype):
     ''' Takes ansible module object, and api resource type (links, plugins, etc.) returns api url'''
@@ -27,38 +50,263 @@ def get_headers(module):
     return headers
 
 
-def check_link_exists(module):
+def decimals_to_floats(value):
+    ''' Takes a value decoded by ijson < 3.1, returns it with Decimals (which ansible cannot serialise) as floats '''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return dict((k, decimals_to_floats(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [decimals_to_floats(v) for v in value]
+    return value
+
+
+def iter_json_items(resp):
+    ''' Takes streamed requests response holding a json array, yields its elements one at a time '''
+    if HAS_IJSON:
+        resp.raw.decode_content = True
+        if IJSON_USE_FLOAT:
+            for item in ijson.items(resp.raw, 'item', use_float=True):
+                yield item
+        else:
+            for item in ijson.items(resp.raw, 'item'):
+                yield decimals_to_floats(item)
+        return
+
+    # Pure python fallback: decode elements straight off the byte stream,
+    # so only the current chunk and element are ever held in memory.
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')()
+    chunks = resp.iter_content(chunk_size=65536)
+    buf = u''
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        while pos < len(buf) and buf[pos] in u' \t\r\n,':
+            pos += 1
+
+        if pos < len(buf) and not started:
+            if buf[pos] != u'[':
+                raise ValueError('expected a json array')
+            started = True
+            pos += 1
+            continue
+
+        if started and pos < len(buf) and buf[pos] == u']':
+            return
+
+        if pos < len(buf):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            # a value touching the end of the buffer may still be truncated
+            if end is not None and (end < len(buf) or eof):
+                yield item
+                pos = end
+                continue
+
+        if eof:
+            raise ValueError('truncated json array')
+
+        buf = buf[pos:]
+        pos = 0
+        try:
+            buf += text_decoder.decode(next(chunks))
+        except StopIteration:
+            buf += text_decoder.decode(b'', True)
+            eof = True
+
+
+def pick_fields(item, fields):
+    ''' Takes a decoded api object and field names, returns a copy holding only those fields '''
+    return dict((k, item[k]) for k in fields if k in item)
+
+
+def coordination_digest(module, *parts):
+    ''' Takes ansible module object and request identity parts, returns a digest naming them in coordination_dir '''
+    ident = [module.params['url'], module.params['org'], module.params['account'], module.params['apikey']]
+    sha = hashlib.sha1()
+    sha.update(json.dumps(ident + list(parts), sort_keys=True).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def coordination_lock(path):
+    ''' Takes lock file path, returns the file opened and exclusively flock'ed '''
+    while True:
+        lock = open(path, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # The file may have been pruned while we waited on it, only the one on disk counts
+        try:
+            if os.fstat(lock.fileno()).st_ino == os.stat(path).st_ino:
+                return lock
+        except OSError:
+            pass
+        lock.close()
+
+
+def prune_coordination(module, cdir):
+    ''' Takes ansible module object and coordination_dir, removes entries older than `coordination_ttl`
+    that no other invocation is holding '''
+    cutoff = time.time() - module.params['coordination_ttl']
+
+    for lock_path in glob.glob(os.path.join(cdir, '*.lock')):
+        path = lock_path[:-len('.lock')]
+        try:
+            mtime = os.stat(path + '.json').st_mtime
+        except OSError:
+            try:
+                mtime = os.stat(lock_path).st_mtime
+            except OSError:
+                continue
+        if mtime >= cutoff:
+            continue
+
+        lock = open(lock_path, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            continue
+        try:
+            for stale in [path + '.json', lock_path]:
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+        finally:
+            lock.close()
+
+    # Leftovers of invocations killed halfway through writing a result
+    for tmp in glob.glob(os.path.join(cdir, '*.tmp')):
+        try:
+            if os.stat(tmp).st_mtime < cutoff:
+                os.remove(tmp)
+        except OSError:
+            pass
+
+
+def coordinated(module, kind, scope, key, fn):
+    ''' Takes ansible module object, request kind ('get' or 'write'), api resource type, request key and a callable.
+    Runs fn() once for identical requests made concurrently by invocations sharing `coordination_dir`
+    and hands its (json serialisable) result to all of them, along with a stamp identifying that run.
+    Writes should include the stamp of the lookup they act upon in their key, so that only writes
+    based on the very same lookup get coalesced '''
+    cdir = module.params['coordination_dir']
+    if not cdir:
+        return fn(), None
+
+    try:
+        os.makedirs(cdir, 0o700)
+    except OSError:
+        if not os.path.isdir(cdir):
+            raise
+
+    prefix = os.path.join(cdir, '%s-%s-' % (kind, coordination_digest(module, scope)))
+    path = prefix + coordination_digest(module, scope, key)
+
+    # Whoever holds the lock does the request, everyone queued behind it reuses the result
+    lock = coordination_lock(path + '.lock')
+    try:
+        try:
+            with open(path + '.json') as f:
+                cached = json.load(f)
+            if time.time() - cached['time'] < module.params['coordination_ttl']:
+                return cached['result'], cached['stamp']
+        except (IOError, ValueError, KeyError):
+            pass
+
+        result = fn()
+        now = time.time()
+        stamp = '%f-%d' % (now, os.getpid())
+
+        if kind == 'write':
+            # Cached lookups of this resource type no longer reflect the api
+            for stale in glob.glob(os.path.join(cdir, 'get-%s-*.json' % coordination_digest(module, scope))):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'time': now, 'stamp': stamp, 'result': result}, f)
+        os.rename(tmp, path + '.json')
+
+        # Write keys are unique per lookup, so without this the directory would only ever grow
+        prune_coordination(module, cdir)
+
+        return result, stamp
+    finally:
+        lock.close()
+
+
+def check_link_exists(module, pairs):
+    ''' Takes ansible module object and (plugin, tags) pairs, returns existence info for each pair as per `match` '''
     api_url = get_api_url(module, 'links')
     headers = get_headers(module)
 
     resp = requests.get(
         api_url,
-        headers=headers
+        headers=headers,
+        stream=True
     )
 
-    out = {'found': False, 'error': False, 'data': None}
+    match = module.params['match']
+    plugins = set(p for p, tags in pairs)
+    missing = set((p, frozenset(tags)) for p, tags in pairs)
+    error = False
+
+    # Built in one pass over the links: exact matches are keyed on (plugin, frozenset(tags)),
+    # subset/superset matches only need scanning the links of their plugin.
+    index = {}
+
+    try:
+        if resp.status_code == 200:
+
+            for link in iter_json_items(resp):
+                if link['plugin'] not in plugins:
+                    continue
+
+                key = (link['plugin'], frozenset(link['tags']))
+                link = pick_fields(link, ['id', 'plugin', 'tags'])
 
-    if resp.status_code == 200:
+                if match == 'exact':
+                    index.setdefault(key, []).append(link)
+                    # Deleting needs every duplicate, creating only needs to know one exists
+                    missing.discard(key)
+                    if not missing and module.params['state'] == 'present':
+                        break
+                else:
+                    index.setdefault(link['plugin'], []).append((key[1], link))
 
-        for link in resp.json():
-            if ( link['plugin'] == module.params['plugin']
-                 and set(link['tags']) == set(module.params['tags'])
-                 ):
-                out['found'] = True
-                out['data'] = link
-                break
+        elif resp.status_code not in [200, 404]:
+            resp.raise_for_status()
+            error = True
+    finally:
+        resp.close()
 
-    elif resp.status_code not in [200, 404]:
-        resp.raise_for_status()
-        out['error'] = True
+    out = []
+    for plugin, tags in pairs:
+        tag_set = frozenset(tags)
+        if match == 'exact':
+            links = index.get((plugin, tag_set), [])
+        elif match == 'subset':
+            links = [l for t, l in index.get(plugin, []) if tag_set <= t]
+        else:
+            links = [l for t, l in index.get(plugin, []) if tag_set >= t]
+
+        out.append({'plugin': plugin, 'tags': tags, 'found': len(links) > 0, 'error': error, 'data': links})
 
     return out
 
 
-def create_link(module):
+def create_link(module, plugin, tags):
     api_url = get_api_url(module,'links')
     headers = get_headers(module)
-    data = {"plugin": module.params['plugin'], "tags": module.params['tags']}
+    data = {"plugin": plugin, "tags": tags}
 
     resp = requests.post(
         api_url,
@@ -70,39 +318,130 @@ def create_link(module):
     return resp
 
 
-def delete_link(module, le):
-    api_url = get_api_url(module,'links/%s' % le['data']['id'])
+def delete_link(module, link):
+    api_url = get_api_url(module,'links/%s' % link['id'])
     headers = get_headers(module)
-    data = {"plugin": module.params['plugin'], "tags": module.params['tags']}
 
     resp = requests.delete(
         api_url,
-        headers=headers,
-        data=json.dumps(data)
+        headers=headers
     )
 
     resp.raise_for_status()
     return resp
 
 
+# Module being profiled, for failures that escape main() to still report their profile
+PROFILED_MODULE = []
+
+
+def setup_profiling(module):
+    ''' Takes ansible module object; with `profile` or `profile_path` set, profiles the rest of the run
+    with cProfile and adds the stats to the result '''
+    if not module.params['profile'] and not module.params['profile_path']:
+        return
+
+    profiler = cProfile.Profile()
+    started = time.time()
+
+    def reporting(exit_fn):
+        def wrapper(**kwargs):
+            profiler.disable()
+            kwargs['profile'] = profile_summary(module, profiler, time.time() - started)
+            exit_fn(**kwargs)
+        return wrapper
+
+    module.exit_json = reporting(module.exit_json)
+    module.fail_json = reporting(module.fail_json)
+    PROFILED_MODULE.append(module)
+    profiler.enable()
+
+
+def profile_summary(module, profiler, elapsed):
+    ''' Takes ansible module object, stopped profiler and run duration, returns a summary of the stats.
+    With `profile_path` set the pstats dump goes there and the summary next to it as <profile_path>.json '''
+    stats = pstats.Stats(profiler)
+    stats.sort_stats('cumulative')
+
+    functions = []
+    for func in stats.fcn_list[:module.params['profile_top']]:
+        cc, nc, tt, ct, callers = stats.stats[func]
+        functions.append({
+            'function': '%s:%d(%s)' % func,
+            'calls': nc,
+            'tottime': round(tt, 6),
+            'cumtime': round(ct, 6)
+        })
+
+    summary = {
+        'wall_time': round(elapsed, 6),
+        'functions': functions,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+    if module.params['profile_path']:
+        try:
+            stats.dump_stats(module.params['profile_path'])
+            with open(module.params['profile_path'] + '.json', 'w') as f:
+                json.dump(summary, f, indent=2)
+            summary['pstats'] = module.params['profile_path']
+        except (IOError, OSError), err:
+            summary['pstats_error'] = str(err)
+
+    return summary
+
+
 def main():
     argument_spec = dict(
         url=dict(required=True),
         org=dict(required=True),
         account=dict(required=True),
         apikey=dict(required=True, no_log=True),
-        plugin=dict(required=True),
+        plugin=dict(required=True, type='list'),
         tags=dict(required=True, type='list'),
-        state=dict(required=False, default='present', choices=['present', 'absent'])
+        match=dict(required=False, default='exact', choices=['exact', 'subset', 'superset']),
+        state=dict(required=False, default='present', choices=['present', 'absent']),
+        coordination_dir=dict(required=False),
+        coordination_ttl=dict(required=False, default=10, type='int'),
+        profile=dict(required=False, default=False, type='bool'),
+        profile_path=dict(required=False),
+        profile_top=dict(required=False, default=20, type='int')
     )
 
     module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=False)
+    setup_profiling(module)
 
     if not HAS_REQUESTS:
         module.fail_json(msg='requests python module is required for this module to work')
 
+    # `tags` is either one tag set, or a list of tag sets each linked to every plugin
+    nested = [isinstance(t, list) for t in module.params['tags']]
+    if nested and all(nested):
+        tag_sets = module.params['tags']
+    elif any(nested):
+        module.fail_json(msg='`tags` must be either a list of tags or a list of tag lists')
+    else:
+        tag_sets = [module.params['tags']]
+
+    pairs = []
+    seen = set()
+    for plugin in module.params['plugin']:
+        for tags in tag_sets:
+            if (plugin, frozenset(tags)) not in seen:
+                seen.add((plugin, frozenset(tags)))
+                pairs.append((plugin, tags))
+
+    # Messages keep their usual form when a single plugin/tags link is managed
+    def note(le, text):
+        if len(pairs) > 1:
+            return '%s [%s]: %s' % (le['plugin'], ', '.join(sorted(le['tags'])), text)
+        return text
+
     try:
-        le = check_link_exists(module)
+        les, le_stamp = coordinated(module, 'get', 'links',
+                                    [module.params['match'], module.params['state'],
+                                     [[p, sorted(tags)] for p, tags in pairs]],
+                                    lambda: check_link_exists(module, pairs))
     except requests.exceptions.RequestException, err_str:
         module.fail_json(msg='Request to check link existence failed', reason=err_str)
 
@@ -110,25 +449,37 @@ def main():
     msg = []
 
     if module.params['state'] == 'present':
-        if le['found']:
-            msg.append('link already exists and contains the specified tag(s)')
-        else:
-            try:
-                create_link(module)
-                msg.append('link created')
-                changed = True
-            except requests.exceptions.RequestException, err_str:
-                module.fail_json(msg='Request to create link failed', reason=err_str)
+        for le in les:
+            if le['found']:
+                msg.append(note(le, 'link already exists and contains the specified tag(s)'))
+            else:
+                try:
+                    coordinated(module, 'write', 'links',
+                                ['POST', le['plugin'], sorted(le['tags']), le_stamp],
+                                lambda: create_link(module, le['plugin'], le['tags']).status_code)
+                    msg.append(note(le, 'link created'))
+                    changed = True
+                except requests.exceptions.RequestException, err_str:
+                    module.fail_json(msg='Request to create link failed', reason=err_str)
     else:
-        if le['found']:
-            try:
-                delete_link(module, le)
-                msg.append('link deleted')
+        # With subset/superset matching several pairs can resolve to the same link
+        deleted = set()
+        for le in les:
+            if le['found']:
+                for link in le['data']:
+                    if link['id'] in deleted:
+                        continue
+                    try:
+                        coordinated(module, 'write', 'links',
+                                    ['DELETE', link['id'], le_stamp],
+                                    lambda: delete_link(module, link).status_code)
+                        deleted.add(link['id'])
+                    except requests.exceptions.RequestException, err_str:
+                        module.fail_json(msg='Request to delete link failed', reason=err_str)
+                msg.append(note(le, 'link deleted'))
                 changed = True
-            except requests.exceptions.RequestException, err_str:
-                module.fail_json(msg='Request to delete link failed', reason=err_str)
-        else:
-            msg.append('link not found, nothing to delete')
+            else:
+                msg.append(note(le, 'link not found, nothing to delete'))
 
     module.exit_json(changed=changed, msg=msg)
 
@@ -136,4 +487,9 @@ def main():
 # import module snippets
 from ansible.module_utils.basic import *
 
-main()
+try:
+    main()
+except Exception, err:
+    if not PROFILED_MODULE:
+        raise
+    PROFILED_MODULE[0].fail_json(msg='%s: %s' % (type(err).__name__, err), exception=traceback.format_exc())
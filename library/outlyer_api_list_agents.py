@@ -6,7 +6,26 @@ try:
 except ImportError:
     HAS_REQUESTS = False
 
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
+# use_float only exists from ijson 3.1, older versions hand numbers back as Decimals
+try:
+    IJSON_USE_FLOAT = HAS_IJSON and tuple(int(v) for v in ijson.__version__.split('.')[:2]) >= (3, 1)
+except (AttributeError, ValueError):
+    IJSON_USE_FLOAT = False
+
 import json
+import codecs
+from decimal import Decimal
+import time
+import cProfile
+import pstats
+import resource
+import traceback
 
 def get_api_url(module, restype):
     ''' Takes ansible module object, and api resource type (links, plugins, etc.) returns api url'''
@@ -27,6 +46,76 @@ def get_headers(module):
     return headers
 
 
+def decimals_to_floats(value):
+    ''' Takes a value decoded by ijson < 3.1, returns it with Decimals (which ansible cannot serialise) as floats '''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return dict((k, decimals_to_floats(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [decimals_to_floats(v) for v in value]
+    return value
+
+
+def iter_json_items(resp):
+    ''' Takes streamed requests response holding a json array, yields its elements one at a time '''
+    if HAS_IJSON:
+        resp.raw.decode_content = True
+        if IJSON_USE_FLOAT:
+            for item in ijson.items(resp.raw, 'item', use_float=True):
+                yield item
+        else:
+            for item in ijson.items(resp.raw, 'item'):
+                yield decimals_to_floats(item)
+        return
+
+    # Pure python fallback: decode elements straight off the byte stream,
+    # so only the current chunk and element are ever held in memory.
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')()
+    chunks = resp.iter_content(chunk_size=65536)
+    buf = u''
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        while pos < len(buf) and buf[pos] in u' \t\r\n,':
+            pos += 1
+
+        if pos < len(buf) and not started:
+            if buf[pos] != u'[':
+                raise ValueError('expected a json array')
+            started = True
+            pos += 1
+            continue
+
+        if started and pos < len(buf) and buf[pos] == u']':
+            return
+
+        if pos < len(buf):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            # a value touching the end of the buffer may still be truncated
+            if end is not None and (end < len(buf) or eof):
+                yield item
+                pos = end
+                continue
+
+        if eof:
+            raise ValueError('truncated json array')
+
+        buf = buf[pos:]
+        pos = 0
+        try:
+            buf += text_decoder.decode(next(chunks))
+        except StopIteration:
+            buf += text_decoder.decode(b'', True)
+            eof = True
+
+
 def list_agents(module):
     ''' Takes ansible module object, returns data for one or all agents '''
     api_url = get_api_url(module, 'agents')
@@ -34,39 +123,101 @@ def list_agents(module):
 
     resp = requests.get(
         api_url,
-        headers=headers
+        headers=headers,
+        stream=True
     )
 
-    data = None
-
-    if resp.status_code == 200:
-        data = resp.json()
+    out = None
 
-    elif resp.status_code not in [200, 404]:
-        resp.raise_for_status()
+    try:
+        if resp.status_code == 200:
+            agents = iter_json_items(resp)
 
-    out = None
+            if module.params['hostname']:
+                for a in agents:
+                    if a['hostname'] == module.params['hostname']:
+                        out = a
+                        break
+            elif module.params['tags']:
+                tagged_agents = []
+                for a in agents:
+                    if set(module.params['tags']).issubset(set(a['tags'])):
+                        tagged_agents.append(a)
 
-    if module.params['hostname']:
-        for a in data:
-            if a['hostname'] == module.params['hostname']:
-                out = a
-                break
-    elif module.params['tags']:
-        tagged_agents = []
-        for a in data:
-            if set(module.params['tags']).issubset(set(a['tags'])):
-                tagged_agents.append(a)
+                if len(tagged_agents) > 0 :
+                    out = tagged_agents
 
-        if len(tagged_agents) > 0 :
-            out = tagged_agents
+            else:
+                out = list(agents)
 
-    else:
-        out = data
+        elif resp.status_code not in [200, 404]:
+            resp.raise_for_status()
+    finally:
+        resp.close()
 
     return out
 
 
+# Module being profiled, for failures that escape main() to still report their profile
+PROFILED_MODULE = []
+
+
+def setup_profiling(module):
+    ''' Takes ansible module object; with `profile` or `profile_path` set, profiles the rest of the run
+    with cProfile and adds the stats to the result '''
+    if not module.params['profile'] and not module.params['profile_path']:
+        return
+
+    profiler = cProfile.Profile()
+    started = time.time()
+
+    def reporting(exit_fn):
+        def wrapper(**kwargs):
+            profiler.disable()
+            kwargs['profile'] = profile_summary(module, profiler, time.time() - started)
+            exit_fn(**kwargs)
+        return wrapper
+
+    module.exit_json = reporting(module.exit_json)
+    module.fail_json = reporting(module.fail_json)
+    PROFILED_MODULE.append(module)
+    profiler.enable()
+
+
+def profile_summary(module, profiler, elapsed):
+    ''' Takes ansible module object, stopped profiler and run duration, returns a summary of the stats.
+    With `profile_path` set the pstats dump goes there and the summary next to it as <profile_path>.json '''
+    stats = pstats.Stats(profiler)
+    stats.sort_stats('cumulative')
+
+    functions = []
+    for func in stats.fcn_list[:module.params['profile_top']]:
+        cc, nc, tt, ct, callers = stats.stats[func]
+        functions.append({
+            'function': '%s:%d(%s)' % func,
+            'calls': nc,
+            'tottime': round(tt, 6),
+            'cumtime': round(ct, 6)
+        })
+
+    summary = {
+        'wall_time': round(elapsed, 6),
+        'functions': functions,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+    if module.params['profile_path']:
+        try:
+            stats.dump_stats(module.params['profile_path'])
+            with open(module.params['profile_path'] + '.json', 'w') as f:
+                json.dump(summary, f, indent=2)
+            summary['pstats'] = module.params['profile_path']
+        except (IOError, OSError), err:
+            summary['pstats_error'] = str(err)
+
+    return summary
+
+
 def main():
     argument_spec = dict(
         url=dict(required=True),
@@ -74,10 +225,14 @@ def main():
         account=dict(required=True),
         apikey=dict(required=True, no_log=True),
         hostname=dict(required=False),
-        tags=dict(required=False, type='list')
+        tags=dict(required=False, type='list'),
+        profile=dict(required=False, default=False, type='bool'),
+        profile_path=dict(required=False),
+        profile_top=dict(required=False, default=20, type='int')
     )
 
     module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=False)
+    setup_profiling(module)
 
     if not HAS_REQUESTS:
         module.fail_json(msg='requests python module is required for this module to work')
@@ -97,4 +252,9 @@ def main():
 
 from ansible.module_utils.basic import *
 
-main()
+try:
+    main()
+except Exception, err:
+    if not PROFILED_MODULE:
+        raise
+    PROFILED_MODULE[0].fail_json(msg='%s: %s' % (type(err).__name__, err), exception=traceback.format_exc())
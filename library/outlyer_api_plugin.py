@@ -6,9 +6,33 @@ try:
 except ImportError:
     HAS_REQUESTS = False
 
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
+# use_float only exists from ijson 3.1, older versions hand numbers back as Decimals
+try:
+    IJSON_USE_FLOAT = HAS_IJSON and tuple(int(v) for v in ijson.__version__.split('.')[:2]) >= (3, 1)
+except (AttributeError, ValueError):
+    IJSON_USE_FLOAT = False
+
 import json
+import codecs
+from decimal import Decimal
+import cProfile
+import pstats
+import resource
+import traceback
 import base64
 import hashlib
+import os
+import glob
+import time
+import fcntl
+import gzip
+import io
 
 def get_api_url(module, restype):
     ''' Takes ansible module object, and api resource type (agents, plugins, etc.) returns api url'''
@@ -29,31 +53,259 @@ def get_headers(module):
     return headers
 
 
+def decimals_to_floats(value):
+    ''' Takes a value decoded by ijson < 3.1, returns it with Decimals (which ansible cannot serialise) as floats '''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return dict((k, decimals_to_floats(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [decimals_to_floats(v) for v in value]
+    return value
+
+
+def iter_json_items(resp):
+    ''' Takes streamed requests response holding a json array, yields its elements one at a time '''
+    if HAS_IJSON:
+        resp.raw.decode_content = True
+        if IJSON_USE_FLOAT:
+            for item in ijson.items(resp.raw, 'item', use_float=True):
+                yield item
+        else:
+            for item in ijson.items(resp.raw, 'item'):
+                yield decimals_to_floats(item)
+        return
+
+    # Pure python fallback: decode elements straight off the byte stream,
+    # so only the current chunk and element are ever held in memory.
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')()
+    chunks = resp.iter_content(chunk_size=65536)
+    buf = u''
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        while pos < len(buf) and buf[pos] in u' \t\r\n,':
+            pos += 1
+
+        if pos < len(buf) and not started:
+            if buf[pos] != u'[':
+                raise ValueError('expected a json array')
+            started = True
+            pos += 1
+            continue
+
+        if started and pos < len(buf) and buf[pos] == u']':
+            return
+
+        if pos < len(buf):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            # a value touching the end of the buffer may still be truncated
+            if end is not None and (end < len(buf) or eof):
+                yield item
+                pos = end
+                continue
+
+        if eof:
+            raise ValueError('truncated json array')
+
+        buf = buf[pos:]
+        pos = 0
+        try:
+            buf += text_decoder.decode(next(chunks))
+        except StopIteration:
+            buf += text_decoder.decode(b'', True)
+            eof = True
+
+
+def pick_fields(item, fields):
+    ''' Takes a decoded api object and field names, returns a copy holding only those fields '''
+    return dict((k, item[k]) for k in fields if k in item)
+
+
+def coordination_digest(module, *parts):
+    ''' Takes ansible module object and request identity parts, returns a digest naming them in coordination_dir '''
+    ident = [module.params['url'], module.params['org'], module.params['account'], module.params['apikey']]
+    sha = hashlib.sha1()
+    sha.update(json.dumps(ident + list(parts), sort_keys=True).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def coordination_lock(path):
+    ''' Takes lock file path, returns the file opened and exclusively flock'ed '''
+    while True:
+        lock = open(path, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # The file may have been pruned while we waited on it, only the one on disk counts
+        try:
+            if os.fstat(lock.fileno()).st_ino == os.stat(path).st_ino:
+                return lock
+        except OSError:
+            pass
+        lock.close()
+
+
+def prune_coordination(module, cdir):
+    ''' Takes ansible module object and coordination_dir, removes entries older than `coordination_ttl`
+    that no other invocation is holding '''
+    cutoff = time.time() - module.params['coordination_ttl']
+
+    for lock_path in glob.glob(os.path.join(cdir, '*.lock')):
+        path = lock_path[:-len('.lock')]
+        try:
+            mtime = os.stat(path + '.json').st_mtime
+        except OSError:
+            try:
+                mtime = os.stat(lock_path).st_mtime
+            except OSError:
+                continue
+        if mtime >= cutoff:
+            continue
+
+        lock = open(lock_path, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            continue
+        try:
+            for stale in [path + '.json', lock_path]:
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+        finally:
+            lock.close()
+
+    # Leftovers of invocations killed halfway through writing a result
+    for tmp in glob.glob(os.path.join(cdir, '*.tmp')):
+        try:
+            if os.stat(tmp).st_mtime < cutoff:
+                os.remove(tmp)
+        except OSError:
+            pass
+
+
+def coordinated(module, kind, scope, key, fn):
+    ''' Takes ansible module object, request kind ('get' or 'write'), api resource type, request key and a callable.
+    Runs fn() once for identical requests made concurrently by invocations sharing `coordination_dir`
+    and hands its (json serialisable) result to all of them, along with a stamp identifying that run.
+    Writes should include the stamp of the lookup they act upon in their key, so that only writes
+    based on the very same lookup get coalesced '''
+    cdir = module.params['coordination_dir']
+    if not cdir:
+        return fn(), None
+
+    try:
+        os.makedirs(cdir, 0o700)
+    except OSError:
+        if not os.path.isdir(cdir):
+            raise
+
+    prefix = os.path.join(cdir, '%s-%s-' % (kind, coordination_digest(module, scope)))
+    path = prefix + coordination_digest(module, scope, key)
+
+    # Whoever holds the lock does the request, everyone queued behind it reuses the result
+    lock = coordination_lock(path + '.lock')
+    try:
+        try:
+            with open(path + '.json') as f:
+                cached = json.load(f)
+            if time.time() - cached['time'] < module.params['coordination_ttl']:
+                return cached['result'], cached['stamp']
+        except (IOError, ValueError, KeyError):
+            pass
+
+        result = fn()
+        now = time.time()
+        stamp = '%f-%d' % (now, os.getpid())
+
+        if kind == 'write':
+            # Cached lookups of this resource type no longer reflect the api
+            for stale in glob.glob(os.path.join(cdir, 'get-%s-*.json' % coordination_digest(module, scope))):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'time': now, 'stamp': stamp, 'result': result}, f)
+        os.rename(tmp, path + '.json')
+
+        # Write keys are unique per lookup, so without this the directory would only ever grow
+        prune_coordination(module, cdir)
+
+        return result, stamp
+    finally:
+        lock.close()
+
+
 def check_plugin_exists(module):
     api_url = get_api_url(module, 'plugins')
     headers = get_headers(module)
 
     resp = requests.get(
         api_url,
-        headers=headers
+        headers=headers,
+        stream=True
     )
 
     out = {'found': False, 'error': False, 'data': None}
 
-    if resp.status_code == 200:
+    try:
+        if resp.status_code == 200:
 
-        for plugin in resp.json():
-            if plugin['name'] == module.params['plugin_name'] and plugin['extension'] == module.params['extension']:
-                out['found'] = True
-                out['data'] = plugin
-                break
+            for plugin in iter_json_items(resp):
+                if plugin['name'] == module.params['plugin_name'] and plugin['extension'] == module.params['extension']:
+                    out['found'] = True
+                    out['data'] = pick_fields(plugin, ['id', 'name', 'extension'])
+                    break
 
-    elif resp.status_code not in [200, 404]:
-        resp.raise_for_status()
-        out['error'] = True
+        elif resp.status_code not in [200, 404]:
+            resp.raise_for_status()
+            out['error'] = True
+    finally:
+        resp.close()
 
     return out
 
+def send_json(module, method, api_url, headers, data):
+    ''' Sends data as a json body, gzip-compressed when larger than `compress_threshold` bytes and the api takes it '''
+    body = json.dumps(data)
+    threshold = module.params['compress_threshold']
+
+    if threshold is not None and len(body) > threshold:
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+            gz.write(body.encode('utf-8'))
+
+        gz_headers = dict(headers)
+        gz_headers['Content-Encoding'] = 'gzip'
+
+        resp = requests.request(
+            method,
+            api_url,
+            headers=gz_headers,
+            data=buf.getvalue()
+        )
+
+        # Anything but a refusal of the encoding is the api's real answer
+        if resp.status_code not in [400, 415]:
+            return resp
+
+    return requests.request(
+        method,
+        api_url,
+        headers=headers,
+        data=body
+    )
+
 def create_plugin(module):
     api_url = get_api_url(module, 'plugins')
     headers = get_headers(module)
@@ -65,11 +317,7 @@ def create_plugin(module):
         "extension": module.params['extension']
     }
 
-    resp = requests.post(
-        api_url,
-        headers=headers,
-        data=json.dumps(data)
-    )
+    resp = send_json(module, 'POST', api_url, headers, data)
 
     resp.raise_for_status()
 
@@ -86,11 +334,7 @@ def update_plugin(module, pl):
         "content": module.params['plugin_content']
     }
 
-    resp = requests.patch(
-        api_url,
-        headers=headers,
-        data=json.dumps(data)
-    )
+    resp = send_json(module, 'PATCH', api_url, headers, data)
 
     resp.raise_for_status()
 
@@ -118,11 +362,139 @@ def get_dl_plugin_sha(module,pl):
         )
 
         resp.raise_for_status()
-        sha = hashlib.sha1()
-        sha.update(resp.json()['content'])
+        sha = plugin_content_sha(module, resp.json()['content'])
         ##module.fail_json(msg=sha.hexdigest())
         return sha
 
+def normalise_content(module, content):
+    ''' Takes ansible module object and plugin content, returns content normalised as per `content_normalisation` '''
+    norm = module.params['content_normalisation']
+
+    if 'line_endings' in norm:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    if 'trailing_whitespace' in norm:
+        content = '\n'.join(l.rstrip(' \t') for l in content.split('\n'))
+    if 'trailing_newline' in norm:
+        content = content.rstrip('\n')
+
+    return content
+
+def plugin_content_sha(module, content):
+    ''' Takes ansible module object and plugin content, returns sha1 of the normalised content '''
+    content = normalise_content(module, content)
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+
+    sha = hashlib.sha1()
+    sha.update(content)
+    return sha
+
+def hash_cache_key(module, pl):
+    ''' Takes ansible module object and found plugin, returns its key in the `hash_cache` file '''
+    # Hashes depend on the normalisation applied, so that's part of the key too
+    return '%s:%s' % (
+        get_api_url(module, 'plugins/%s' % pl['data']['id']),
+        ','.join(sorted(module.params['content_normalisation']))
+    )
+
+def load_hash_cache(module):
+    ''' Takes ansible module object, returns the remote content hashes recorded in `hash_cache` '''
+    if not module.params['hash_cache']:
+        return {}
+
+    try:
+        with open(module.params['hash_cache']) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def store_hash_cache(module, key, sha):
+    ''' Takes ansible module object, cache key and hex sha; records it in `hash_cache`,
+    or with sha None forgets the plugin under every normalisation '''
+    path = module.params['hash_cache']
+    if not path:
+        return
+
+    lock = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = load_hash_cache(module)
+        if sha is None:
+            plugin_url = key.rsplit(':', 1)[0]
+            for k in list(cache):
+                if k.rsplit(':', 1)[0] == plugin_url:
+                    del cache[k]
+        else:
+            cache[key] = sha
+
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmp, path)
+    finally:
+        lock.close()
+
+
+# Module being profiled, for failures that escape main() to still report their profile
+PROFILED_MODULE = []
+
+
+def setup_profiling(module):
+    ''' Takes ansible module object; with `profile` or `profile_path` set, profiles the rest of the run
+    with cProfile and adds the stats to the result '''
+    if not module.params['profile'] and not module.params['profile_path']:
+        return
+
+    profiler = cProfile.Profile()
+    started = time.time()
+
+    def reporting(exit_fn):
+        def wrapper(**kwargs):
+            profiler.disable()
+            kwargs['profile'] = profile_summary(module, profiler, time.time() - started)
+            exit_fn(**kwargs)
+        return wrapper
+
+    module.exit_json = reporting(module.exit_json)
+    module.fail_json = reporting(module.fail_json)
+    PROFILED_MODULE.append(module)
+    profiler.enable()
+
+
+def profile_summary(module, profiler, elapsed):
+    ''' Takes ansible module object, stopped profiler and run duration, returns a summary of the stats.
+    With `profile_path` set the pstats dump goes there and the summary next to it as <profile_path>.json '''
+    stats = pstats.Stats(profiler)
+    stats.sort_stats('cumulative')
+
+    functions = []
+    for func in stats.fcn_list[:module.params['profile_top']]:
+        cc, nc, tt, ct, callers = stats.stats[func]
+        functions.append({
+            'function': '%s:%d(%s)' % func,
+            'calls': nc,
+            'tottime': round(tt, 6),
+            'cumtime': round(ct, 6)
+        })
+
+    summary = {
+        'wall_time': round(elapsed, 6),
+        'functions': functions,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+    if module.params['profile_path']:
+        try:
+            stats.dump_stats(module.params['profile_path'])
+            with open(module.params['profile_path'] + '.json', 'w') as f:
+                json.dump(summary, f, indent=2)
+            summary['pstats'] = module.params['profile_path']
+        except (IOError, OSError), err:
+            summary['pstats_error'] = str(err)
+
+    return summary
+
+
 def main():
     argument_spec = dict(
         url=dict(required=True),
@@ -134,16 +506,31 @@ def main():
         description=dict(required=False,default='bad practice'),
         type=dict(required=False,default='script'),
         extension=dict(required=False, default='py'),
-        state=dict(required=False, default='present', choices=['present', 'absent'])
+        state=dict(required=False, default='present', choices=['present', 'absent']),
+        coordination_dir=dict(required=False),
+        coordination_ttl=dict(required=False, default=10, type='int'),
+        content_normalisation=dict(required=False, default=[], type='list'),
+        hash_cache=dict(required=False),
+        compress_threshold=dict(required=False, type='int'),
+        profile=dict(required=False, default=False, type='bool'),
+        profile_path=dict(required=False),
+        profile_top=dict(required=False, default=20, type='int')
     )
 
     module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=False)
+    setup_profiling(module)
 
     if not HAS_REQUESTS:
         module.fail_json(msg='requests python module is required for this module to work')
 
+    for n in module.params['content_normalisation']:
+        if n not in ['line_endings', 'trailing_whitespace', 'trailing_newline']:
+            module.fail_json(msg='unknown `content_normalisation` %s, expected line_endings, trailing_whitespace or trailing_newline' % n)
+
     try:
-        pl = check_plugin_exists(module)
+        pl, pl_stamp = coordinated(module, 'get', 'plugins',
+                                   [module.params['plugin_name'], module.params['extension']],
+                                   lambda: check_plugin_exists(module))
     except requests.exceptions.RequestException, err_str:
         module.fail_json(msg='Request to check plugin existence failed', reason=err_str)
 
@@ -155,13 +542,29 @@ def main():
 
     if module.params['state'] == 'present':
         if pl['found']:
-            content_sha = hashlib.sha1()
+            if not module.params['plugin_content']:
+                module.fail_json(msg='`plugin_content` is required to update plugin')
+
             #content_sha.update(base64.b64decode(module.params['plugin_content']))
-            content_sha.update(module.params['plugin_content'])
-            dl_content_sha = get_dl_plugin_sha(module,pl)
-            if dl_content_sha.hexdigest() != content_sha.hexdigest():
-                up = update_plugin(module, pl)
+            content_sha = plugin_content_sha(module, module.params['plugin_content']).hexdigest()
+
+            # A hash recorded by an earlier run spares downloading the content again
+            cache_key = hash_cache_key(module, pl)
+            dl_content_sha = load_hash_cache(module).get(cache_key)
+            dl_stamp = None
+            if dl_content_sha != content_sha:
+                dl_content_sha, dl_stamp = coordinated(module, 'get', 'plugins',
+                                                       ['content', pl['data']['id'],
+                                                        sorted(module.params['content_normalisation'])],
+                                                       lambda: get_dl_plugin_sha(module,pl).hexdigest())
+                store_hash_cache(module, cache_key, dl_content_sha)
+
+            if dl_content_sha != content_sha:
+                up = coordinated(module, 'write', 'plugins',
+                                 ['PATCH', pl['data']['id'], content_sha, dl_stamp],
+                                 lambda: update_plugin(module, pl).status_code)[0]
                 if up:
+                    store_hash_cache(module, cache_key, content_sha)
                     changed = True
                     msg.append('plugin updated')
             else:
@@ -170,14 +573,21 @@ def main():
             if not module.params['plugin_content']:
                 module.fail_json(msg='`plugin_content` is required to create new plugin')
                 
-            cp = create_plugin(module)
+            content_sha = plugin_content_sha(module, module.params['plugin_content']).hexdigest()
+            cp = coordinated(module, 'write', 'plugins',
+                             ['POST', module.params['plugin_name'], module.params['extension'],
+                              module.params['description'], content_sha, pl_stamp],
+                             lambda: create_plugin(module).status_code)[0]
             if cp:
                 changed = True
                 msg.append('plugin created')
     else:
         if pl['found']:
             try:
-                rm_plugin(module, pl)
+                coordinated(module, 'write', 'plugins',
+                            ['DELETE', pl['data']['id'], pl_stamp],
+                            lambda: rm_plugin(module, pl).status_code)
+                store_hash_cache(module, hash_cache_key(module, pl), None)
                 msg.append('plugin deleted')
                 changed = True
             except requests.exceptions.RequestException, err_str:
@@ -191,4 +601,9 @@ def main():
 # import module snippets
 from ansible.module_utils.basic import *
 
-main()
+try:
+    main()
+except Exception, err:
+    if not PROFILED_MODULE:
+        raise
+    PROFILED_MODULE[0].fail_json(msg='%s: %s' % (type(err).__name__, err), exception=traceback.format_exc())
@@ -6,8 +6,28 @@ try:
 except ImportError:
     HAS_REQUESTS = False
 
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
+# use_float only exists from ijson 3.1, older versions hand numbers back as Decimals
+try:
+    IJSON_USE_FLOAT = HAS_IJSON and tuple(int(v) for v in ijson.__version__.split('.')[:2]) >= (3, 1)
+except (AttributeError, ValueError):
+    IJSON_USE_FLOAT = False
+
 import json
+import codecs
+from decimal import Decimal
+import time
+import cProfile
+import pstats
+import resource
+import traceback
 import hashlib
+from multiprocessing.pool import ThreadPool
 
 def get_api_url(module, restype):
     ''' Takes ansible module object, and api resource type (agents, rules, etc.) returns api url'''
@@ -29,36 +49,122 @@ def get_headers(module):
     return headers
 
 
-def check_rule_exists(module):
+def decimals_to_floats(value):
+    ''' Takes a value decoded by ijson < 3.1, returns it with Decimals (which ansible cannot serialise) as floats '''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return dict((k, decimals_to_floats(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [decimals_to_floats(v) for v in value]
+    return value
+
+
+def iter_json_items(resp):
+    ''' Takes streamed requests response holding a json array, yields its elements one at a time '''
+    if HAS_IJSON:
+        resp.raw.decode_content = True
+        if IJSON_USE_FLOAT:
+            for item in ijson.items(resp.raw, 'item', use_float=True):
+                yield item
+        else:
+            for item in ijson.items(resp.raw, 'item'):
+                yield decimals_to_floats(item)
+        return
+
+    # Pure python fallback: decode elements straight off the byte stream,
+    # so only the current chunk and element are ever held in memory.
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')()
+    chunks = resp.iter_content(chunk_size=65536)
+    buf = u''
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        while pos < len(buf) and buf[pos] in u' \t\r\n,':
+            pos += 1
+
+        if pos < len(buf) and not started:
+            if buf[pos] != u'[':
+                raise ValueError('expected a json array')
+            started = True
+            pos += 1
+            continue
+
+        if started and pos < len(buf) and buf[pos] == u']':
+            return
+
+        if pos < len(buf):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            # a value touching the end of the buffer may still be truncated
+            if end is not None and (end < len(buf) or eof):
+                yield item
+                pos = end
+                continue
+
+        if eof:
+            raise ValueError('truncated json array')
+
+        buf = buf[pos:]
+        pos = 0
+        try:
+            buf += text_decoder.decode(next(chunks))
+        except StopIteration:
+            buf += text_decoder.decode(b'', True)
+            eof = True
+
+
+def pick_fields(item, fields):
+    ''' Takes a decoded api object and field names, returns a copy holding only those fields '''
+    return dict((k, item[k]) for k in fields if k in item)
+
+
+def check_rule_exists(module, rule_names):
+    ''' Takes ansible module object and rule titles, returns existence info for each title '''
     api_url = get_api_url(module, 'rules')
     headers = get_headers(module)
 
     resp = requests.get(
         api_url,
-        headers=headers
+        headers=headers,
+        stream=True
     )
 
-    out = {'found': False, 'error': False, 'data': None}
-
-    if resp.status_code == 200:
+    out = {}
+    for name in rule_names:
+        out[name] = {'found': False, 'error': False, 'data': None}
 
-        for rule in resp.json():
-            if rule['title'] == module.params['rule_name']:
-                out['found'] = True
-                out['data'] = rule
-                break
-
-    elif resp.status_code not in [200, 404]:
-        resp.raise_for_status()
-        out['error'] = True
+    try:
+        if resp.status_code == 200:
+
+            missing = set(rule_names)
+            for rule in iter_json_items(resp):
+                if rule['title'] in missing:
+                    out[rule['title']]['found'] = True
+                    out[rule['title']]['data'] = pick_fields(rule, ['id', 'title'])
+                    missing.discard(rule['title'])
+                    if not missing:
+                        break
+
+        elif resp.status_code not in [200, 404]:
+            resp.raise_for_status()
+            for name in rule_names:
+                out[name]['error'] = True
+    finally:
+        resp.close()
 
     return out
 
 
-def create_rule(module):
+def create_rule(module, rule_content):
     api_url = get_api_url(module, 'rules')
     headers = get_headers(module)
-    data = module.params['rule_content']
+    data = rule_content
 
     resp = requests.post(
         api_url,
@@ -71,10 +177,10 @@ def create_rule(module):
     return resp
 
 
-def update_rule(module, rl):
+def update_rule(module, rl, rule_content):
     api_url = get_api_url(module,'rules/%s' % rl['data']['id'])
     headers = get_headers(module)
-    data = module.params['rule_content']
+    data = rule_content
 
     resp = requests.put(
         api_url,
@@ -113,40 +219,124 @@ def get_ol_rule(module,rl):
         return resp.json()
 
 
-def compare_rules(module,rl):
-    params_rule_json = json.loads(module.params['rule_content'])
-    ol_rule_json = get_ol_rule(module,rl)
+def get_ol_rules(module, rls):
+    ''' Takes ansible module object and a list of found rules, fetches their full definitions concurrently '''
+    if len(rls) < 2:
+        return [get_ol_rule(module, rl) for rl in rls]
+
+    pool = ThreadPool(max(1, min(module.params['concurrency'], len(rls))))
+    try:
+        return pool.map(lambda rl: get_ol_rule(module, rl), rls)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def sort_key(d):
+    ''' Stable ordering key for actions and criteria, independent of dict ordering '''
+    return json.dumps(d, sort_keys=True)
+
+
+def canonical_rule(rule):
+    ''' Takes a decoded rule, returns the sections we compare with actions and criteria in a stable order '''
+    return {
+        'title': rule.get('title'),
+        'description': rule.get('description'),
+        'actions': sorted(rule.get('actions') or [], key=sort_key),
+        'criteria': sorted(rule.get('criteria') or [], key=sort_key)
+    }
+
 
+def canonical_ol_rule(ol_rule):
+    ''' Takes a rule as returned by the api, returns it reshaped like the rules we send, leaving the original untouched '''
     # We need a fairly extensive preprocessing here, as inputs and outputs have some major differences.
     # Plus unicode fun.
-    for d in ol_rule_json['actions']:
-        if u'id' in d:
-            del d[u'id']
-
-    for d in ol_rule_json['criteria']:
-        if u'id' in d:
-            del d[u'id']
-        if u'data_type' in d:
-            del d[u'data_type']
-        if u'rule' in d:
-            del d[u'rule']
-        if u'state' in d:
-            del d[u'state']
-        if u'sources' in d:
-            del d[u'sources']
+    actions = []
+    for d in ol_rule.get('actions') or []:
+        actions.append(dict((k, v) for k, v in d.items() if k != u'id'))
+
+    criteria = []
+    for d in ol_rule.get('criteria') or []:
+        c = dict((k, v) for k, v in d.items()
+                 if k not in (u'id', u'data_type', u'rule', u'state', u'sources', u'scopes'))
         if u'scopes' in d:
-            d[u'scope'] = dict( tag = d[u'scopes'][0][u'id'] )
-            del d[u'scopes']
+            c[u'scope'] = dict( tag = d[u'scopes'][0][u'id'] )
+        criteria.append(c)
+
+    return canonical_rule({
+        'title': ol_rule.get('title'),
+        'description': ol_rule.get('description'),
+        'actions': actions,
+        'criteria': criteria
+    })
+
 
+def compare_rules(rule_content, ol_rule):
+    ''' Takes rule json we send and rule as returned by the api, returns True if they are equivalent '''
     # We only compare selected sections as actual rule has a few more than we ever send
-    if (    ol_rule_json['title'] != params_rule_json['title']
-            or ol_rule_json['description'] != params_rule_json['description']
-            or ol_rule_json['actions'] != params_rule_json['actions']
-            or ol_rule_json['criteria'] != params_rule_json['criteria']
-        ):
-        return False
-    else:
-        return True
+    return canonical_rule(json.loads(rule_content)) == canonical_ol_rule(ol_rule)
+
+
+# Module being profiled, for failures that escape main() to still report their profile
+PROFILED_MODULE = []
+
+
+def setup_profiling(module):
+    ''' Takes ansible module object; with `profile` or `profile_path` set, profiles the rest of the run
+    with cProfile and adds the stats to the result '''
+    if not module.params['profile'] and not module.params['profile_path']:
+        return
+
+    profiler = cProfile.Profile()
+    started = time.time()
+
+    def reporting(exit_fn):
+        def wrapper(**kwargs):
+            profiler.disable()
+            kwargs['profile'] = profile_summary(module, profiler, time.time() - started)
+            exit_fn(**kwargs)
+        return wrapper
+
+    module.exit_json = reporting(module.exit_json)
+    module.fail_json = reporting(module.fail_json)
+    PROFILED_MODULE.append(module)
+    # Only the main thread is profiled, worker threads show up as time spent waiting on them
+    profiler.enable()
+
+
+def profile_summary(module, profiler, elapsed):
+    ''' Takes ansible module object, stopped profiler and run duration, returns a summary of the stats.
+    With `profile_path` set the pstats dump goes there and the summary next to it as <profile_path>.json '''
+    stats = pstats.Stats(profiler)
+    stats.sort_stats('cumulative')
+
+    functions = []
+    for func in stats.fcn_list[:module.params['profile_top']]:
+        cc, nc, tt, ct, callers = stats.stats[func]
+        functions.append({
+            'function': '%s:%d(%s)' % func,
+            'calls': nc,
+            'tottime': round(tt, 6),
+            'cumtime': round(ct, 6)
+        })
+
+    summary = {
+        'wall_time': round(elapsed, 6),
+        'functions': functions,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+    if module.params['profile_path']:
+        try:
+            stats.dump_stats(module.params['profile_path'])
+            with open(module.params['profile_path'] + '.json', 'w') as f:
+                json.dump(summary, f, indent=2)
+            summary['pstats'] = module.params['profile_path']
+        except (IOError, OSError), err:
+            summary['pstats_error'] = str(err)
+
+    return summary
+
 
 def main():
     argument_spec = dict(
@@ -154,54 +344,99 @@ def main():
         org=dict(required=True),
         account=dict(required=True),
         apikey=dict(required=True, no_log=True),
-        rule_name=dict(required=True),
+        rule_name=dict(required=False),
         rule_content=dict(required=False, type='jsonarg'),
-        state=dict(required=False, default='present', choices=['present', 'absent'])
+        rules=dict(required=False, type='list'),
+        concurrency=dict(required=False, default=4, type='int'),
+        state=dict(required=False, default='present', choices=['present', 'absent']),
+        profile=dict(required=False, default=False, type='bool'),
+        profile_path=dict(required=False),
+        profile_top=dict(required=False, default=20, type='int')
     )
 
     module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=False)
+    setup_profiling(module)
 
     if not HAS_REQUESTS:
         module.fail_json(msg='requests python module is required for this module to work')
 
+    if module.params['rule_name'] and module.params['rules']:
+        module.fail_json(msg='`rule_name` and `rules` parameters are mutually exclusive')
+    if module.params['rule_content'] and module.params['rules']:
+        module.fail_json(msg='`rule_content` and `rules` parameters are mutually exclusive')
+
+    # (rule_name, rule_content) pairs, rule_content being a json string or None
+    wanted = []
+    if module.params['rules']:
+        for r in module.params['rules']:
+            if not isinstance(r, dict) or not r.get('rule_name'):
+                module.fail_json(msg='each `rules` entry needs a `rule_name`')
+            if r['rule_name'] in [name for name, content in wanted]:
+                module.fail_json(msg='`rules` contains `rule_name` %s more than once' % r['rule_name'])
+            content = r.get('rule_content')
+            if content is not None and not isinstance(content, basestring):
+                content = json.dumps(content)
+            wanted.append((r['rule_name'], content))
+    elif module.params['rule_name']:
+        wanted.append((module.params['rule_name'], module.params['rule_content']))
+    else:
+        module.fail_json(msg='one of `rule_name` or `rules` is required')
+
+    # Messages keep their usual form when a single `rule_name` is managed
+    def note(name, text):
+        if module.params['rules']:
+            return '%s: %s' % (name, text)
+        return text
+
     try:
-        rl = check_rule_exists(module)
+        rls = check_rule_exists(module, [name for name, content in wanted])
     except requests.exceptions.RequestException, err_str:
         module.fail_json(msg='Request to check rule existence failed', reason=err_str)
 
     # DEBUG
-    ###module.fail_json(msg=rl)
+    ###module.fail_json(msg=rls)
 
     changed = False
     msg = []
 
     if module.params['state'] == 'present':
-        if rl['found']:
-            if not compare_rules(module,rl):
-                ur = update_rule(module, rl)
-                if ur:
-                    changed = True
-                    msg.append('rule updated')
+        for name, content in wanted:
+            if not content:
+                module.fail_json(msg=note(name, '`rule_content` is required to create or update a rule'))
+
+        found = [name for name, content in wanted if rls[name]['found']]
+        try:
+            ol_rules = dict(zip(found, get_ol_rules(module, [rls[name] for name in found])))
+        except requests.exceptions.RequestException, err_str:
+            module.fail_json(msg='Request to fetch rule details failed', reason=err_str)
+
+        for name, content in wanted:
+            rl = rls[name]
+            if rl['found']:
+                if not compare_rules(content, ol_rules[name]):
+                    ur = update_rule(module, rl, content)
+                    if ur:
+                        changed = True
+                        msg.append(note(name, 'rule updated'))
+                else:
+                    msg.append(note(name, 'no need to update rule'))
             else:
-                msg.append('no need to update rule')
-        else:
-            if not module.params['rule_content']:
-                module.fail_json(msg='`rule_content` is required to create new rule')
-
-            cr = create_rule(module)
-            if cr:
-                changed = True
-                msg.append('rule created')
+                cr = create_rule(module, content)
+                if cr:
+                    changed = True
+                    msg.append(note(name, 'rule created'))
     else:
-        if rl['found']:
-            try:
-                rm_rule(module, rl)
-                msg.append('rule deleted')
-                changed = True
-            except requests.exceptions.RequestException, err_str:
-                module.fail_json(msg='Request to delete rule failed', reason=err_str)
-        else:
-            msg.append('rule not found')
+        for name, content in wanted:
+            rl = rls[name]
+            if rl['found']:
+                try:
+                    rm_rule(module, rl)
+                    msg.append(note(name, 'rule deleted'))
+                    changed = True
+                except requests.exceptions.RequestException, err_str:
+                    module.fail_json(msg='Request to delete rule failed', reason=err_str)
+            else:
+                msg.append(note(name, 'rule not found'))
 
     module.exit_json(changed=changed, msg=msg)
 
@@ -209,4 +444,9 @@ def main():
 # import module snippets
 from ansible.module_utils.basic import *
 
-main()
+try:
+    main()
+except Exception, err:
+    if not PROFILED_MODULE:
+        raise
+    PROFILED_MODULE[0].fail_json(msg='%s: %s' % (type(err).__name__, err), exception=traceback.format_exc())
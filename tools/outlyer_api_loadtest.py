@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+# Load and soak test harness for the Outlyer api modules
+#
+# Runs the modules in library/ the way ansible does (one process per task, args in a
+# json file) from --forks concurrent workers, against an in-process mock of the Outlyer
+# api which injects latency, jitter and 429/5xx responses. Reports task latency
+# percentiles, throughput, api calls per task, and peak rss of the module processes
+# (with its trend over the run) next to the mock api's own rss.
+#
+# Needs ansible and requests importable by --python, e.g.:
+#   python tools/outlyer_api_loadtest.py --agents 10000 --forks 50 --tasks 2000
+#   python tools/outlyer_api_loadtest.py --forks 50 --duration 1800 --error-rate-429 0.01
+
+from __future__ import division, print_function
+
+import argparse
+import gzip
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+LIBRARY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'library')
+
+MODULES = [
+    'outlyer_api_list_agents',
+    'outlyer_api_tag_agent',
+    'outlyer_api_link',
+    'outlyer_api_plugin',
+    'outlyer_api_rule',
+]
+
+
+class MockOutlyer(object):
+    ''' In-memory stand-in for the Outlyer api collections, with call accounting and fault injection '''
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.calls = {}
+        self.statuses = {}
+        self.db = {'agents': [], 'links': [], 'plugins': [], 'rules': []}
+
+        for i in range(opts.agents):
+            self.db['agents'].append({
+                'id': 'agent-%d' % i,
+                'hostname': 'host-%d.example.com' % i,
+                'tags': ['env:load', 'group:%d' % (i % 20)],
+                'status': 'UP',
+                'version': '1.0.0'
+            })
+        for i in range(opts.plugins):
+            self.add('plugins', {'name': 'lt-plugin-%d' % i, 'extension': 'py', 'description': 'load test',
+                                 'content': plugin_content(i)})
+        for i in range(opts.links):
+            self.add('links', {'plugin': 'lt-plugin-%d' % (i % max(opts.plugins, 1)),
+                               'tags': ['group:%d' % (i % 20)]})
+        for i in range(opts.rules):
+            self.add('rules', json.loads(rule_content(i)))
+
+    def add(self, coll, obj):
+        self.next_id += 1
+        obj['id'] = str(self.next_id)
+        self.db[coll].append(obj)
+        return obj
+
+    def count(self, key, status):
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def handle(self, method, path, body):
+        ''' Returns (status, response object) for an api call '''
+        m = re.match(r'^/orgs/[^/]+/accounts/[^/]+/(agents|links|plugins|rules)(?:/([^/]+))?(/tags)?$', path)
+        if not m:
+            return 404, {'message': 'not found'}
+        coll, item_id, tags = m.groups()
+
+        with self.lock:
+            items = self.db[coll]
+
+            if item_id is None:
+                if method == 'GET':
+                    return 200, list(items)
+                if method == 'POST' and isinstance(body, dict):
+                    return 201, self.add(coll, dict(body))
+                return 405, {'message': 'method not allowed'}
+
+            found = [x for x in items if x['id'] == item_id]
+            if not found:
+                return 404, {'message': 'not found'}
+            item = found[0]
+
+            if tags:
+                if method == 'PUT':
+                    item['tags'] = item['tags'] + [t for t in body['names'] if t not in item['tags']]
+                elif method == 'DELETE':
+                    item['tags'] = [t for t in item['tags'] if t not in body['tags']]
+                else:
+                    return 405, {'message': 'method not allowed'}
+                return 200, item
+
+            if method == 'GET':
+                return 200, item
+            if method == 'DELETE':
+                items.remove(item)
+                return 204, None
+            if method in ['PUT', 'PATCH'] and isinstance(body, dict):
+                if method == 'PUT':
+                    item.clear()
+                    item['id'] = item_id
+                item.update(dict((k, v) for k, v in body.items() if k != 'id'))
+                return 200, item
+            return 405, {'message': 'method not allowed'}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+def make_handler(api):
+    opts = api.opts
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def dispatch(self, method):
+            path = self.path.split('?')[0]
+            m = re.match(r'^/orgs/[^/]+/accounts/[^/]+/(\w+)(/[^/]+)?(/tags)?$', path)
+            if m:
+                resource = m.group(1) + ('/{id}' if m.group(2) else '') + (m.group(3) or '')
+            else:
+                resource = path
+
+            delay = opts.latency + random.uniform(0, opts.jitter)
+            if delay:
+                time.sleep(delay / 1000.0)
+
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length else b''
+
+            roll = random.random()
+            if roll < opts.error_rate_429:
+                status, obj = 429, {'message': 'rate limited'}
+            elif roll < opts.error_rate_429 + opts.error_rate_5xx:
+                status, obj = random.choice([500, 502, 503]), {'message': 'injected failure'}
+            else:
+                try:
+                    if self.headers.get('Content-Encoding') == 'gzip':
+                        raw = gzip.GzipFile(fileobj=io.BytesIO(raw)).read()
+                    body = json.loads(raw.decode('utf-8')) if raw else None
+                except ValueError:
+                    status, obj = 400, {'message': 'bad json'}
+                else:
+                    status, obj = api.handle(method, path, body)
+
+            api.count('%s %s' % (method, resource), status)
+
+            out = json.dumps(obj).encode('utf-8') if obj is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out)))
+            if status == 429:
+                self.send_header('Retry-After', '1')
+            self.end_headers()
+            self.wfile.write(out)
+
+        def do_GET(self):
+            self.dispatch('GET')
+
+        def do_POST(self):
+            self.dispatch('POST')
+
+        def do_PUT(self):
+            self.dispatch('PUT')
+
+        def do_PATCH(self):
+            self.dispatch('PATCH')
+
+        def do_DELETE(self):
+            self.dispatch('DELETE')
+
+    return Handler
+
+
+def plugin_content(i):
+    return '#!/usr/bin/env python\n# load test plugin %d\nprint("OK | value=%d")\n' % (i, i)
+
+
+def rule_content(i):
+    return json.dumps({
+        'title': 'lt-rule-%d' % i,
+        'description': 'load test rule %d' % i,
+        'actions': [{'type': 'email', 'email': 'ops%d@example.com' % (i % 3)}],
+        'criteria': [{'metric': 'sys.cpu.pct', 'operator': '>', 'threshold': 90 + i % 10,
+                      'scope': {'tag': 'group:%d' % (i % 20)}}]
+    })
+
+
+def task_args(opts, module, n):
+    ''' Returns the module arguments for the n-th task running module '''
+    agent = random.randrange(max(opts.agents, 1))
+    plugin = n % max(opts.plugins, 1)
+
+    if module == 'outlyer_api_list_agents':
+        return {'hostname': 'host-%d.example.com' % agent}
+    if module == 'outlyer_api_tag_agent':
+        return {'agent_id': 'agent-%d' % agent, 'tags': ['loadtest']}
+    if module == 'outlyer_api_link':
+        args = {'plugin': 'lt-plugin-%d' % plugin, 'tags': ['group:%d' % (n % 20), 'env:load']}
+    elif module == 'outlyer_api_plugin':
+        args = {'plugin_name': 'lt-plugin-%d' % plugin, 'plugin_content': plugin_content(plugin)}
+    else:
+        return {'rule_name': 'lt-rule-%d' % (n % max(opts.rules, 1)),
+                'rule_content': rule_content(n % max(opts.rules, 1))}
+
+    if opts.coordination_dir:
+        args['coordination_dir'] = opts.coordination_dir
+    return args
+
+
+# Runs a module as __main__ and, at interpreter exit (exit_json/fail_json end in sys.exit),
+# writes the process's own peak rss to the file named in OUTLYER_LOADTEST_HWM. VmHWM is
+# reset on exec so, unlike wait4's ru_maxrss, it is not floored at the harness's rss.
+HWM_SHIM = """
+import atexit, os, sys
+def hwm():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    with open(os.environ['OUTLYER_LOADTEST_HWM'], 'w') as out:
+                        out.write(line.split()[1])
+    except IOError:
+        pass
+atexit.register(hwm)
+sys.argv = sys.argv[1:]
+sys.path[0] = os.path.dirname(sys.argv[0])
+code = compile(open(sys.argv[0]).read(), sys.argv[0], 'exec')
+exec(code, {'__name__': '__main__', '__file__': sys.argv[0]})
+"""
+
+
+def run_task(opts, api_url, workdir, module, n):
+    ''' Runs one module invocation, returns its result record '''
+    args = {'url': api_url, 'org': 'loadtest', 'account': 'loadtest', 'apikey': 'loadtest'}
+    args.update(task_args(opts, module, n))
+
+    fd, args_file = tempfile.mkstemp(prefix='args-', dir=workdir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'ANSIBLE_MODULE_ARGS': args}, f)
+    fd, hwm_file = tempfile.mkstemp(prefix='hwm-', dir=workdir)
+    os.close(fd)
+    env = dict(os.environ, OUTLYER_LOADTEST_HWM=hwm_file)
+
+    start = time.time()
+    proc = subprocess.Popen([opts.python, '-c', HWM_SHIM, os.path.join(opts.library, module + '.py'), args_file],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = proc.communicate()
+    latency = time.time() - start
+    os.remove(args_file)
+
+    # Left empty where /proc is unavailable, or if the module was killed
+    with open(hwm_file) as f:
+        hwm = f.read().strip()
+    os.remove(hwm_file)
+
+    failed = proc.returncode != 0
+    msg = None
+    try:
+        result = json.loads(out.decode('utf-8', 'replace').strip().splitlines()[-1])
+        failed = failed or bool(result.get('failed'))
+        msg = result.get('msg')
+    except (ValueError, IndexError):
+        failed = True
+        msg = err.decode('utf-8', 'replace').strip().splitlines()[-1:] or 'no output'
+
+    return {'module': module, 'start': start, 'latency': latency, 'failed': failed, 'msg': msg,
+            'rss_kb': int(hwm) if hwm else None}
+
+
+def rss_kb():
+    ''' Current resident set size of the harness process, i.e. mostly the mock api, in kB '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, pct):
+    ''' Nearest-rank percentile of a sorted list '''
+    if not values:
+        return 0.0
+    return values[max(0, int(math.ceil(pct / 100.0 * len(values))) - 1)]
+
+
+def latency_row(name, results):
+    lat = sorted(r['latency'] for r in results)
+    rss = sorted(r['rss_kb'] for r in results if r['rss_kb'] is not None)
+    return {
+        'module': name,
+        'tasks': len(results),
+        'failed': len([r for r in results if r['failed']]),
+        'p50': percentile(lat, 50),
+        'p95': percentile(lat, 95),
+        'p99': percentile(lat, 99),
+        'max': lat[-1] if lat else 0.0,
+        'rss_p50_kb': percentile(rss, 50) if rss else None,
+        'rss_max_kb': rss[-1] if rss else None,
+    }
+
+
+def run(opts):
+    api = MockOutlyer(opts)
+    server = ThreadingHTTPServer(('127.0.0.1', opts.port), make_handler(api))
+    api_url = 'http://127.0.0.1:%d' % server.server_address[1]
+    threading.Thread(target=server.serve_forever).start()
+
+    workdir = tempfile.mkdtemp(prefix='outlyer-loadtest-')
+    results = []
+    samples = []
+    lock = threading.Lock()
+    counter = [0]
+    started = time.time()
+    deadline = started + opts.duration if opts.duration else None
+
+    def next_task():
+        with lock:
+            n = counter[0]
+            if deadline is None and n >= opts.tasks:
+                return None
+            if deadline is not None and time.time() >= deadline:
+                return None
+            counter[0] += 1
+            return opts.modules[n % len(opts.modules)], n
+
+    def worker():
+        while True:
+            task = next_task()
+            if task is None:
+                return
+            r = run_task(opts, api_url, workdir, task[0], task[1])
+            with lock:
+                results.append(r)
+
+    def sample():
+        ''' Records mock rss and the peak rss of module processes finished since the previous sample '''
+        window = sorted(r['rss_kb'] for r in results[sampled[0]:] if r['rss_kb'] is not None)
+        sampled[0] = len(results)
+        samples.append({
+            'elapsed': time.time() - started,
+            'tasks': len(results),
+            'api_calls': api.total_calls(),
+            'task_rss_p50_kb': percentile(window, 50) if window else None,
+            'task_rss_max_kb': window[-1] if window else None,
+            'mock_rss_kb': rss_kb(),
+        })
+
+    def sampler():
+        while not done.wait(opts.sample_interval):
+            with lock:
+                sample()
+
+    done = threading.Event()
+    sampled = [0]
+    sample()
+    sampling = threading.Thread(target=sampler)
+    sampling.start()
+
+    workers = [threading.Thread(target=worker) for i in range(opts.forks)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    elapsed = time.time() - started
+    done.set()
+    sampling.join()
+    sample()
+    server.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    failures = {}
+    for r in results:
+        if r['failed']:
+            key = '%s: %s' % (r['module'], r['msg'])
+            failures[key] = failures.get(key, 0) + 1
+
+    report = {
+        'elapsed': elapsed,
+        'throughput': len(results) / elapsed if elapsed else 0.0,
+        'api_calls': api.total_calls(),
+        'amplification': api.total_calls() / len(results) if results else 0.0,
+        'calls': api.calls,
+        'statuses': dict((str(k), v) for k, v in api.statuses.items()),
+        'latency': [latency_row('all', results)] +
+                   [latency_row(m, [r for r in results if r['module'] == m]) for m in opts.modules],
+        'failures': failures,
+        'memory': samples,
+        'task_rss_growth_kb': None,
+        'mock_rss_growth_kb': samples[-1]['mock_rss_kb'] - samples[0]['mock_rss_kb'],
+    }
+
+    # Growth of the typical module process between the first and last windows that ran tasks
+    windows = [x['task_rss_p50_kb'] for x in samples if x['task_rss_p50_kb'] is not None]
+    if windows:
+        report['task_rss_growth_kb'] = windows[-1] - windows[0]
+
+    return report
+
+
+def print_report(report):
+    print('%d tasks in %.1fs, %.1f tasks/s' % (report['latency'][0]['tasks'], report['elapsed'], report['throughput']))
+    print('%d api calls, %.2f calls per task' % (report['api_calls'], report['amplification']))
+    print('')
+    print('%-26s %7s %7s %8s %8s %8s %8s %12s %12s' % (
+        'module', 'tasks', 'failed', 'p50', 'p95', 'p99', 'max', 'rss p50', 'rss max'))
+    for row in report['latency']:
+        if row['rss_p50_kb'] is None:
+            rss = '%12s %12s' % ('-', '-')
+        else:
+            rss = '%10dkB %10dkB' % (row['rss_p50_kb'], row['rss_max_kb'])
+        print('%-26s %7d %7d %7.3fs %7.3fs %7.3fs %7.3fs %s' % (
+            row['module'], row['tasks'], row['failed'], row['p50'], row['p95'], row['p99'], row['max'], rss))
+    print('')
+    print('api calls:')
+    for key in sorted(report['calls']):
+        print('  %-30s %7d' % (key, report['calls'][key]))
+    print('responses: %s' % ', '.join('%s=%d' % kv for kv in sorted(report['statuses'].items())))
+    if report['failures']:
+        print('')
+        print('failures:')
+        for key, n in sorted(report['failures'].items(), key=lambda kv: -kv[1]):
+            print('  %5d  %s' % (n, key))
+    print('')
+    print('%10s %8s %10s %14s %14s %12s' % ('elapsed', 'tasks', 'api calls', 'task rss p50', 'task rss max', 'mock rss'))
+    for s in report['memory']:
+        if s['task_rss_p50_kb'] is None:
+            task_rss = '%14s %14s' % ('-', '-')
+        else:
+            task_rss = '%12dkB %12dkB' % (s['task_rss_p50_kb'], s['task_rss_max_kb'])
+        print('%9.1fs %8d %10d %s %10dkB' % (s['elapsed'], s['tasks'], s['api_calls'], task_rss, s['mock_rss_kb']))
+    if report['task_rss_growth_kb'] is not None:
+        print('module process rss growth (p50, first to last window): %+dkB' % report['task_rss_growth_kb'])
+    print('mock api rss growth: %+dkB' % report['mock_rss_growth_kb'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load and soak test the Outlyer api modules against a mock api')
+    parser.add_argument('--modules', default=','.join(MODULES),
+                        help='comma separated modules to run, tasks are spread evenly over them')
+    parser.add_argument('--forks', type=int, default=50, help='concurrent module invocations')
+    parser.add_argument('--tasks', type=int, default=500, help='number of tasks to run (ignored with --duration)')
+    parser.add_argument('--duration', type=float, default=0, help='soak: keep running tasks for this many seconds')
+    parser.add_argument('--agents', type=int, default=10000)
+    parser.add_argument('--plugins', type=int, default=50)
+    parser.add_argument('--links', type=int, default=200)
+    parser.add_argument('--rules', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=20, help='base api latency in ms')
+    parser.add_argument('--jitter', type=float, default=10, help='random extra api latency, up to this many ms')
+    parser.add_argument('--error-rate-429', type=float, default=0.0, help='fraction of api calls answered 429')
+    parser.add_argument('--error-rate-5xx', type=float, default=0.0, help='fraction of api calls answered 500/502/503')
+    parser.add_argument('--coordination-dir', help='passed as coordination_dir to the link and plugin modules')
+    parser.add_argument('--sample-interval', type=float, default=10, help='seconds between memory samples')
+    parser.add_argument('--port', type=int, default=0, help='mock api port (default: any free port)')
+    parser.add_argument('--python', default=sys.executable, help='interpreter running the modules')
+    parser.add_argument('--library', default=LIBRARY_DIR, help='directory holding the modules')
+    parser.add_argument('--seed', type=int, help='random seed, for repeatable runs')
+    parser.add_argument('--json', help='also write the full report to this file')
+    opts = parser.parse_args()
+
+    opts.modules = [m.strip() for m in opts.modules.split(',') if m.strip()]
+    for m in opts.modules:
+        if m not in MODULES:
+            parser.error('unknown module %s' % m)
+    if opts.forks < 1:
+        parser.error('--forks must be at least 1')
+    if opts.seed is not None:
+        random.seed(opts.seed)
+
+    report = run(opts)
+    print_report(report)
+
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()